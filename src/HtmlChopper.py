@@ -1,9 +1,31 @@
 """Module used to seperate the HTML file into multiple files
 based on the sections and subsections in the HTML file."""
 
+import multiprocessing
 import os
 import sys
-from bs4 import BeautifulSoup, Tag, NavigableString
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from lxml import etree, html
+
+# Input files are UTF-8, whatever their <meta> charset declares
+HTML_PARSER = html.HTMLParser(encoding='utf-8')
+
+# XPath expressions are compiled once at import instead of on every call
+SECTION_XPATH = etree.XPath('//*[starts-with(@id, "section-")]')
+STYLESHEET_XPATH = etree.XPath(
+    './/link[contains(concat(" ", normalize-space(@rel), " "), " stylesheet ")]')
+SUBSECTION_H2_XPATH = etree.XPath('.//h2[@class="compendium-hr heading-anchor"]')
+
+# Below this many sections the process pool is not started; pickling and
+# re-parsing every section costs more than the extra cores can win back
+MIN_PARALLEL_SECTIONS = 16
+
+# Every output page is PAGE_OPEN + <head> + BODY_OPEN + body content +
+# PAGE_SUFFIX; split_html joins the parts before the content once per run
+PAGE_OPEN = b'<!DOCTYPE html>\n<html>'
+BODY_OPEN = b'<body>'
+PAGE_SUFFIX = b'</body></html>'
 
 
 def print_python_version():
@@ -13,33 +35,224 @@ def print_python_version():
     print(sys.version)
 
 
-def update_css_paths(head, css):
+def list_css_files(css_dir):
+    """
+    Returns the names of the entries in the CSS folder, read with a single
+    directory scan. The folder does not change during a run.
+    """
+    if not os.path.isdir(css_dir):
+        return frozenset()
+    with os.scandir(css_dir) as entries:
+        return frozenset(entry.name for entry in entries)
+
+
+def css_file_exists(css_dir, css_files, file_name):
+    """
+    Returns True if file_name is in the CSS folder. The scanned names are
+    checked first; a miss falls back to the filesystem, which still matches
+    names case-insensitively on Windows and macOS.
+    """
+    return (file_name in css_files
+            or os.path.exists(os.path.join(css_dir, file_name)))
+
+
+def update_css_paths(head, css, css_files):
     """
     Updates <link> tags in the <head> section to use the CSS files in the given folder.
     """
-    for link in head.find_all('link', rel="stylesheet"):
+    for link in STYLESHEET_XPATH(head):
         original_href = link.get('href', '')
-        css_file_path = os.path.join(css, os.path.basename(original_href))
-        if os.path.exists(css_file_path):
-            link['href'] = os.path.relpath(
-                css_file_path, os.path.dirname(original_href)).replace('\\', '/')
+        css_file_name = os.path.basename(original_href)
+        if css_file_exists(css, css_files, css_file_name):
+            css_file_path = os.path.join(css, css_file_name)
+            link.set('href', os.path.relpath(
+                css_file_path, os.path.dirname(original_href)).replace('\\', '/'))
 
 
-def update_img_paths(soup, css_dir, output_dir):
+def normalize_meta_charset(head):
+    """
+    Leaves a single <meta charset="utf-8"> in the <head>, the encoding the
+    input is read in and every output file is written in. Content-Type
+    <meta> tags are turned into this form too, since libxml2 drops them
+    when serializing.
+    """
+    declared = False
+    for meta in list(head.iter('meta')):
+        is_content_type = meta.get('http-equiv', '').lower() == 'content-type'
+        if not is_content_type and meta.get('charset') is None:
+            continue
+        if declared:
+            meta.drop_tree()
+            continue
+        meta.attrib.clear()
+        meta.set('charset', 'utf-8')
+        declared = True
+
+
+@lru_cache(maxsize=4096)
+def _remap_img_src(img_src, css_dir, output_dir, css_files):
+    """
+    Returns the path of the image in the css_folder relative to output_dir,
+    or None if the image is not there. The same src values recur across
+    sections and subsections, so results are cached.
+    """
+    img_file_name = os.path.basename(img_src)
+    if not css_file_exists(css_dir, css_files, img_file_name):
+        return None
+    img_file_path = os.path.join(css_dir, img_file_name)
+    return os.path.relpath(img_file_path, output_dir).replace(os.path.sep, '/')
+
+
+def update_img_paths(element, css_dir, output_dir, css_files):
     """
     Updates <img> tags to use the correct path for images in the css_folder.
+    The given element itself is included if it is an <img>. Returns the
+    <img> tags that were updated.
     """
-    for img_tag in soup.find_all('img'):
+    updated = []
+    for img_tag in element.iter('img'):
         img_src = img_tag.get('src', '')
         if img_src:
-            img_file_name = os.path.basename(img_src)
-            img_file_path = os.path.join(css_dir, img_file_name)
-            if os.path.exists(img_file_path):
-                new_src = os.path.relpath(
-                    img_file_path, output_dir).replace(os.path.sep, '/')
-                img_tag['src'] = new_src
+            new_src = _remap_img_src(img_src, css_dir, output_dir, css_files)
+            if new_src is not None:
+                img_tag.set('src', new_src)
+                updated.append(img_tag)
             else:
+                img_file_path = os.path.join(css_dir, os.path.basename(img_src))
                 print(f"Image file does not exist: {img_file_path}")
+    return updated
+
+
+def group_subsections(section):
+    """
+    Pairs every <h2 class="compendium-hr heading-anchor"> in the section with
+    the tags that follow it up to the next <h2>. Each parent of such an <h2>
+    has its children walked once, instead of once per <h2>.
+    """
+    h2_tags = SUBSECTION_H2_XPATH(section)
+    following = {}
+    walked_parents = set()
+    for h2_tag in h2_tags:
+        parent = h2_tag.getparent()
+        if parent in walked_parents:
+            continue
+        walked_parents.add(parent)
+        siblings = None
+        # Iterating by tag skips comments and processing instructions
+        for child in parent.iterchildren(tag=etree.Element):
+            if child.tag == "h2":
+                siblings = following.setdefault(child, [])
+            elif siblings is not None:
+                siblings.append(child)
+    return [(h2_tag, following[h2_tag]) for h2_tag in h2_tags]
+
+
+def _write_file(write):
+    """
+    Writes a single (path, parts, message) entry and prints its message.
+    The byte parts are written one after another rather than joined first.
+    """
+    path, parts, message = write
+    with open(path, 'wb') as file:
+        for part in parts:
+            file.write(part)
+    print(message)
+
+
+def make_folders(writes):
+    """
+    Creates the folders for the collected (path, parts, message) entries,
+    once per distinct folder.
+    """
+    for folder in {os.path.dirname(path) for path, _, _ in writes}:
+        os.makedirs(folder, exist_ok=True)
+
+
+def write_files(writes):
+    """
+    Writes the collected (path, parts, message) entries using a thread pool.
+    Folders are created up front so the workers only open and write files.
+    """
+    make_folders(writes)
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Consume the results so any write error is raised here
+        list(executor.map(_write_file, writes))
+
+
+def build_section_writes(section, section_num, page_prefix, output_dir, css_dir,
+                         css_files):
+    """
+    Returns the (path, parts, message) entries for one section and its <h2>
+    subsections. Image paths in the section are updated along the way.
+    """
+    writes = []
+    section_id = section.get('id')
+    section_folder_name = section_id.replace('section-', '')
+    section_folder = os.path.join(
+        output_dir, f"{section_num:03d}_{section_folder_name}")
+
+    # Update image paths in the section
+    section_imgs = update_img_paths(section, css_dir, section_folder, css_files)
+
+    section_file = os.path.join(
+        section_folder, f"{section_folder_name}.html")
+    section_parts = (page_prefix,
+                     html.tostring(section, encoding='utf-8', with_tail=False),
+                     PAGE_SUFFIX)
+    writes.append((section_file, section_parts,
+                   f"Saved section {section_id} to {section_file}"))
+
+    # Split <h2> children into their own files
+    subsection_num = 0
+    subsection_folder = f"{section_folder}/subsections"
+    subsections = group_subsections(section)
+    if subsections:
+        # The section file is already serialized, so the images found
+        # above can be pointed at the subsections folder in one pass
+        for img_tag in section_imgs:
+            img_tag.set('src', _remap_img_src(
+                img_tag.get('src'), css_dir, subsection_folder, css_files))
+    for h2_tag, siblings in subsections:
+        subsection_num += 1
+        subsection_id = h2_tag.get('id') or f"subsection-{subsection_num:03d}"
+        subsection_file = (
+            f"{subsection_folder}/{subsection_num:03d}_{subsection_id}.html")
+
+        # Gather all content following this <h2> tag until the next <h2>
+        content = [
+            html.tostring(element, encoding='utf-8', with_tail=False)
+            for element in (h2_tag, *siblings)  # Start with the <h2> tag itself
+        ]
+
+        subsection_parts = (page_prefix, b''.join(content), PAGE_SUFFIX)
+        writes.append((subsection_file, subsection_parts,
+                       f"Saved subsection {subsection_id} to {subsection_file}"))
+
+    return writes
+
+
+def process_section(section_html, section_tag, section_id, section_num,
+                    page_prefix, output_dir, css_dir, css_files):
+    """
+    Writes one section and its <h2> subsections to their own files. Runs in
+    a worker process, so the section arrives serialized and is parsed again.
+    The files are written one by one; the other workers already overlap I/O.
+    Returns False, writing nothing, if the parsed section is not the one that
+    was sent, which happens to elements such as <body> out of their document.
+    """
+    try:
+        section = html.fragment_fromstring(section_html, parser=HTML_PARSER)
+    except etree.ParserError:
+        return False
+    if section.tag != section_tag or section.get('id') != section_id:
+        return False
+    writes = build_section_writes(
+        section, section_num, page_prefix, output_dir, css_dir, css_files)
+    make_folders(writes)
+    for write in writes:
+        _write_file(write)
+    return True
 
 
 def split_html(input_file, output_dir, css_dir):
@@ -49,78 +262,51 @@ def split_html(input_file, output_dir, css_dir):
     with <h2 class="compendium-hr heading-anchor"> tags, saving all text following
     each <h2> tag until the next <h2> tag with the same class is encountered.
     Also updates <img> tags with the correct path to images.
+    Sections are independent of each other and are processed in parallel
+    when there are enough of them and more than one CPU.
     """
-    with open(input_file, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-
-    section_num = 0
-    doctype = '<!DOCTYPE html>'
-    head = soup.find('head')
-    if head:
-        update_css_paths(head, css_dir)
-        head_content = str(head.prettify())
-
-    sections = soup.find_all(id=lambda x: x and x.startswith('section-'))
-    for section in sections:
-        section_num += 1
-        section_id = section.get('id')
-        section_folder_name = section_id.replace('section-', '')
-        section_folder = os.path.join(
-            output_dir, f"{section_num:03d}_{section_folder_name}")
-        os.makedirs(section_folder, exist_ok=True)
-
-        # Update image paths in the section
-        update_img_paths(section, css_dir, section_folder)
-
-        section_file = os.path.join(
-            section_folder, f"{section_folder_name}.html")
-        with open(section_file, 'w', encoding='utf-8') as file:
-            if head:
-                file.write(f"""{doctype}\n<html>{
-                    head_content}<body>{str(section)}</body></html>""")
-                print(f"Saved section {section_id} to {section_file}")
-            else:
-                file.write(f"""{doctype}\n<html
-                           ><head></head><body>{str(section)}</body></html>""")
-                print(f"Saved section {section_id} to {section_file}")
-
-        # Split <h2> children into their own files
-        subsection_num = 0
-        h2_tags = section.find_all('h2', class_="compendium-hr heading-anchor")
-        for h2_tag in h2_tags:
-            subsection_num += 1
-            subsection_id = h2_tag.get(
-                'id', None) or f"subsection-{hash(h2_tag)}"
-            # Gather all content following this <h2> tag until the next <h2>
-            content = [str(h2_tag)]  # Start with the <h2> tag itself
-            next_node = h2_tag
-            while True:
-                next_node = next_node.find_next_sibling()
-                if next_node is None:
-                    break
-                if isinstance(next_node, NavigableString):
-                    content.append(next_node.strip())
-                elif isinstance(next_node, Tag):
-                    if next_node.name == "h2":
-                        break
-                    content.append(str(next_node))
-
-            subsection_folder = os.path.join(section_folder, 'subsections')
-            os.makedirs(subsection_folder, exist_ok=True)
-            subsection_file = os.path.join(
-                subsection_folder, f"{subsection_num:03d}_{subsection_id}.html")
-
-            # Create a BeautifulSoup object for the subsection content
-            subsection_soup = BeautifulSoup(''.join(content), 'html.parser')
-
-            # Update image paths in the subsection
-            update_img_paths(subsection_soup, css_dir, subsection_folder)
-
-            with open(subsection_file, 'w', encoding='utf-8') as file:
-                file.write(f"""{doctype}\n{
-                           head_content}<body>{str(subsection_soup)}</body></html>""")
-            print(f"Saved subsection {subsection_id} to {subsection_file}")
+    # lxml reads and decodes the file itself, keeping the bytes in C
+    tree = html.parse(input_file, parser=HTML_PARSER)
+
+    root = tree.getroot()
+    if root is None:
+        # An empty file has no head and no sections to split
+        print("HTML splitting complete!")
+        return
+
+    css_files = list_css_files(css_dir)
+    head = root.find('head')
+    if head is not None:
+        update_css_paths(head, css_dir, css_files)
+        normalize_meta_charset(head)
+        head_bytes = html.tostring(head, encoding='utf-8', with_tail=False)
+    else:
+        head_bytes = b'<head></head>'
+    # The doctype, <head> and <body> open tag are identical for every page,
+    # so they are encoded and joined once
+    page_prefix = PAGE_OPEN + head_bytes + BODY_OPEN
+
+    sections = list(enumerate(SECTION_XPATH(tree), start=1))
+    if (os.cpu_count() or 1) > 1 and len(sections) >= MIN_PARALLEL_SECTIONS:
+        # Live lxml elements cannot be pickled, so each section is handed to
+        # its worker as serialized bytes
+        tasks = [
+            (html.tostring(section, encoding='utf-8', with_tail=False),
+             section.tag, section.get('id'), section_num, page_prefix,
+             output_dir, css_dir, css_files)
+            for section_num, section in sections
+        ]
+        with multiprocessing.Pool() as pool:
+            handled = pool.starmap(process_section, tasks)
+        # Sections a worker could not rebuild are split here instead
+        sections = [item for item, done in zip(sections, handled) if not done]
 
+    writes = []
+    for section_num, section in sections:
+        writes.extend(build_section_writes(
+            section, section_num, page_prefix, output_dir, css_dir, css_files))
+    # All parsing is done; the remaining work is pure file I/O
+    write_files(writes)
     print("HTML splitting complete!")
 
 
@@ -0,0 +1,94 @@
+"""Regression tests for HtmlChopper.split_html."""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('lxml')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import HtmlChopper  # noqa: E402
+
+
+def split(tmp_path, markup):
+    """
+    Runs split_html on the given markup and returns the output folder.
+    """
+    input_file = tmp_path / 'input.html'
+    input_file.write_bytes(markup.encode('utf-8'))
+    output_dir = tmp_path / 'out'
+    HtmlChopper.split_html(str(input_file), str(output_dir), str(tmp_path / 'css'))
+    return output_dir
+
+
+def test_content_type_meta_becomes_utf8_charset(tmp_path):
+    output_dir = split(tmp_path, (
+        '<html><head><meta http-equiv="Content-Type" '
+        'content="text/html; charset=ISO-8859-1"><title>ü</title></head>'
+        '<body><div id="section-a"><h2 class="compendium-hr heading-anchor" '
+        'id="first">First</h2><p>intro é</p></div></body></html>'))
+
+    for page in (output_dir / '001_a' / 'a.html',
+                 output_dir / '001_a' / 'subsections' / '001_first.html'):
+        content = page.read_bytes().decode('utf-8')
+        assert '<meta charset="utf-8">' in content
+        assert 'intro é' in content
+        assert '<title>ü</title>' in content
+
+
+def test_duplicate_charset_declarations_are_dropped(tmp_path):
+    output_dir = split(tmp_path, (
+        '<html><head><meta charset="iso-8859-1">'
+        '<meta http-equiv="content-type" content="text/html; charset=iso-8859-1">'
+        '</head><body><div id="section-a"><p>x</p></div></body></html>'))
+
+    content = (output_dir / '001_a' / 'a.html').read_text(encoding='utf-8')
+    assert content.count('<meta') == 1
+    assert '<meta charset="utf-8">' in content
+
+
+def test_non_ascii_text_without_charset_meta(tmp_path):
+    output_dir = split(tmp_path, (
+        '<html><head><title>Tést</title></head>'
+        '<body><div id="section-a"><p>intro é</p></div></body></html>'))
+
+    content = (output_dir / '001_a' / 'a.html').read_text(encoding='utf-8')
+    assert '<title>Tést</title>' in content
+    assert 'intro é' in content
+
+
+def test_empty_input_file(tmp_path, capsys):
+    output_dir = split(tmp_path, '')
+
+    assert not output_dir.exists()
+    assert 'HTML splitting complete!' in capsys.readouterr().out
+
+
+def test_worker_writes_a_section_it_can_rebuild(tmp_path):
+    section_html = (b'<div id="section-x"><h2 class="compendium-hr heading-anchor" '
+                    b'id="a">A</h2><p>a</p></div>')
+    assert HtmlChopper.process_section(
+        section_html, 'div', 'section-x', 1, b'<head></head>',
+        str(tmp_path / 'out'), str(tmp_path / 'css'), frozenset())
+    assert (tmp_path / 'out' / '001_x' / 'subsections' / '001_a.html').exists()
+
+
+def test_worker_rejects_a_section_it_cannot_rebuild(tmp_path):
+    # Out of its document a <body> parses as its children, losing the id
+    section_html = (b'<body id="section-x"><h2 class="compendium-hr heading-anchor">'
+                    b'A</h2><p>a</p></body>')
+    assert not HtmlChopper.process_section(
+        section_html, 'body', 'section-x', 1, b'<head></head>',
+        str(tmp_path / 'out'), str(tmp_path / 'css'), frozenset())
+    assert not (tmp_path / 'out').exists()
+
+
+def test_css_file_lookup_falls_back_to_the_filesystem(tmp_path):
+    (tmp_path / 'logo.png').write_bytes(b'')
+
+    assert HtmlChopper.css_file_exists(str(tmp_path), frozenset({'logo.png'}), 'logo.png')
+    # A name missing from the scan, as with a different case on Windows or
+    # macOS, is still looked up on disk
+    assert HtmlChopper.css_file_exists(str(tmp_path), frozenset(), 'logo.png')
+    assert not HtmlChopper.css_file_exists(str(tmp_path), frozenset(), 'other.png')